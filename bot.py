@@ -1,9 +1,16 @@
 import os
-import json
+import asyncio
 import time
 import logging
-from dataclasses import dataclass, asdict
-from typing import Dict, Any, Optional, List, Tuple
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+from operator import attrgetter
+from dataclasses import dataclass, fields
+from typing import Dict, Any, Optional, List, Set, Tuple
+
+import orjson
 
 from telegram import (
     Update,
@@ -14,7 +21,9 @@ from telegram import (
     ReplyKeyboardRemove,
 )
 from telegram.constants import ChatType
+from telegram.error import BadRequest, NetworkError, TelegramError, TimedOut
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -32,14 +41,12 @@ STATE_FILE = (os.getenv("STATE_FILE") or "state.json").strip()
 # Reminder interval (default 10 minutes)
 REMIND_EVERY_MIN_DEFAULT = int((os.getenv("REMIND_EVERY_MIN") or "10").strip() or "10")
 
+# state.json snapshot interval (default 10 seconds); changes in between go to the WAL
+SNAPSHOT_EVERY_SEC = max(1, int((os.getenv("SNAPSHOT_EVERY_SEC") or "10").strip() or "10"))
+
 # Admin IDs: "123,456" (optional)
 ADMIN_IDS_RAW = (os.getenv("ADMIN_IDS") or "").strip()
-ADMIN_IDS = set()
-if ADMIN_IDS_RAW:
-    for x in ADMIN_IDS_RAW.split(","):
-        x = x.strip()
-        if x.isdigit():
-            ADMIN_IDS.add(int(x))
+ADMIN_IDS = frozenset(int(x) for x in ADMIN_IDS_RAW.split(",") if x.strip().isdigit())
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN topilmadi. Variables ga BOT_TOKEN qo'ying.")
@@ -54,54 +61,205 @@ logging.basicConfig(
 log = logging.getLogger("saudiya-taxi-bot")
 
 # ================== STATE ==================
+# state.json is a periodic snapshot; every mutation in between is appended to
+# state.json.wal as one JSON line and replayed on top of the snapshot at load.
+WAL_FILE = STATE_FILE + ".wal"
+WAL_OLD_FILE = WAL_FILE + ".old"
+WAL_FLUSH_EVERY_SEC = 2
+
+_DIRTY = False  # WAL has deltas not yet folded into a snapshot
+
+def apply_delta(state: Dict[str, Any], op: str, path: List[str], val: Any) -> None:
+    node = state
+    for key in path[:-1]:
+        node = node.setdefault(key, {})
+    if op == "set":
+        node[path[-1]] = val
+    elif op == "del":
+        node.pop(path[-1], None)
+
+def replay_wal(state: Dict[str, Any], path: str) -> None:
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    d = orjson.loads(line)
+                except ValueError:
+                    # oxirgi qator yarim yozilgan bo'lishi mumkin (crash)
+                    log.warning("state wal: broken line skipped")
+                    continue
+                apply_delta(state, d["o"], d["p"], d.get("v"))
+    except FileNotFoundError:
+        pass
+    except Exception:
+        log.exception("state wal replay failed")
+
+# A crash mid-append leaves an unterminated last line. Cut it off before the
+# WAL is reopened for append, or the next delta would be glued onto it.
+def trim_wal_tail(path: str) -> None:
+    try:
+        with open(path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+                log.warning("state wal: torn last line dropped (%s)", path)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        log.exception("state wal tail repair failed")
+
 def load_state() -> Dict[str, Any]:
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(STATE_FILE, "rb") as f:
+            state = orjson.loads(f.read())
     except FileNotFoundError:
-        return {"orders": {}, "users": {}, "settings": {}}
+        state = {"orders": {}, "settings": {}}
     except Exception:
         log.exception("state load failed")
-        return {"orders": {}, "users": {}, "settings": {}}
+        state = {"orders": {}, "settings": {}}
+
+    # .wal.old: snapshot yozilayotganda ajratilgan WAL (yozuv tugamay qolgan bo'lsa)
+    for path in (WAL_OLD_FILE, WAL_FILE):
+        trim_wal_tail(path)
+        replay_wal(state, path)
+    return state
+
+# Encoded JSON of each order as of its last store; store_order drops the entry,
+# so a snapshot re-encodes only orders that changed since the previous one.
+_ORDER_JSON: Dict[str, bytes] = {}
+
+def encode_state(state: Dict[str, Any]) -> bytes:
+    parts = []
+    for oid, data in state["orders"].items():
+        enc = _ORDER_JSON.get(oid)
+        if enc is None:
+            enc = _ORDER_JSON[oid] = orjson.dumps(data)
+        parts.append(orjson.dumps(oid) + b":" + enc)
+    rest = orjson.dumps(
+        {k: v for k, v in state.items() if k != "orders"},
+        option=orjson.OPT_NON_STR_KEYS,
+    )
+    # {"orders":{...}, <rest>} — rest "{...}" ning qavslarisiz qo'shiladi
+    out = b'{"orders":{' + b",".join(parts) + b"}"
+    if rest != b"{}":
+        out += b"," + rest[1:-1]
+    return out + b"}"
+
+# Runs in a worker thread from snapshot_tick: touches only the snapshot file.
+# Written to a temp file and swapped in, so a crash never leaves a torn state.json.
+def write_snapshot(data: bytes) -> bool:
+    tmp = STATE_FILE + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, STATE_FILE)
+    except Exception:
+        log.exception("state save failed")
+        return False
+    return True
+
+def drop_wal_old() -> None:
+    try:
+        os.remove(WAL_OLD_FILE)
+    except FileNotFoundError:
+        pass
 
 def save_state(state: Dict[str, Any]) -> None:
+    global _DIRTY
+    if not write_snapshot(encode_state(state)):
+        return
+    # snapshot hamma narsani o'z ichiga oldi — WAL endi kerak emas
+    _wal_fp.truncate(0)
+    drop_wal_old()
+    _DIRTY = False
+
+def rotate_wal() -> None:
+    # Hozirgi WAL .wal.old ga o'tadi, yangi deltalar bo'sh WAL ga yoziladi.
+    # Oldingi snapshot yozilmay qolgan bo'lsa, .wal.old ustiga qo'shiladi.
+    global _wal_fp
+    _wal_fp.close()
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        if os.path.exists(WAL_OLD_FILE):
+            with open(WAL_FILE, "rb") as src, open(WAL_OLD_FILE, "ab") as dst:
+                dst.write(src.read())
+            os.remove(WAL_FILE)
+        else:
+            os.replace(WAL_FILE, WAL_OLD_FILE)
+    finally:
+        _wal_fp = open(WAL_FILE, "ab", buffering=8192)
+
+_WAL_OPTS = orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+
+def log_delta(op: str, path: List[str], val: Any = None) -> None:
+    global _DIRTY
+    try:
+        _wal_fp.write(orjson.dumps({"o": op, "p": path, "v": val}, option=_WAL_OPTS))
+        _DIRTY = True
     except Exception:
-        log.exception("state save failed")
+        log.exception("state wal write failed")
+
+def flush_wal() -> None:
+    try:
+        _wal_fp.flush()
+    except Exception:
+        log.exception("state wal flush failed")
 
 STATE = load_state()
 STATE.setdefault("orders", {})
-STATE.setdefault("users", {})
+# wizard step endi context.user_data da — eski fayllardagi "users" kerak emas
+STATE.pop("users", None)
 STATE.setdefault("settings", {})
+ORDERS: Dict[str, Dict[str, Any]] = STATE["orders"]
+SETTINGS: Dict[str, Any] = STATE["settings"]
+
+_wal_fp = open(WAL_FILE, "ab", buffering=8192)
+
+_REMIND_EVERY_SEC: Optional[int] = None  # parsed SETTINGS value, reset on change
 
 def get_remind_every_sec() -> int:
-    sec = int(STATE["settings"].get("remind_every_sec", REMIND_EVERY_MIN_DEFAULT * 60))
-    return max(60, sec)
+    global _REMIND_EVERY_SEC
+    if _REMIND_EVERY_SEC is None:
+        sec = int(SETTINGS.get("remind_every_sec", REMIND_EVERY_MIN_DEFAULT * 60))
+        _REMIND_EVERY_SEC = max(60, sec)
+    return _REMIND_EVERY_SEC
 
 def set_remind_every_min(minutes: int) -> None:
+    global _REMIND_EVERY_SEC
     minutes = max(1, int(minutes))
-    STATE["settings"]["remind_every_sec"] = minutes * 60
-    save_state(STATE)
+    if SETTINGS.get("remind_every_sec") == minutes * 60:
+        return
+    _REMIND_EVERY_SEC = None
+    SETTINGS["remind_every_sec"] = minutes * 60
+    log_delta("set", ["settings", "remind_every_sec"], minutes * 60)
 
 def get_default_price_text() -> str:
     # ✅ default: Kelishilgan narxda
-    return (STATE["settings"].get("default_price_text") or "Kelishilgan narxda").strip() or "Kelishilgan narxda"
+    return (SETTINGS.get("default_price_text") or "Kelishilgan narxda").strip() or "Kelishilgan narxda"
 
 def set_default_price_text(text: str) -> None:
     text = (text or "").strip() or "Kelishilgan narxda"
-    STATE["settings"]["default_price_text"] = text
-    save_state(STATE)
+    if SETTINGS.get("default_price_text") == text:
+        return
+    SETTINGS["default_price_text"] = text
+    log_delta("set", ["settings", "default_price_text"], text)
 
 def now_ts() -> int:
     return int(time.time())
 
+_LAST_ORDER_MS = 0
+
 def new_order_id() -> str:
-    return str(int(time.time() * 1000))
+    # millisekund; bir ms ichida ikkita buyurtma bo'lsa ham ID takrorlanmaydi
+    global _LAST_ORDER_MS
+    _LAST_ORDER_MS = max(time.time_ns() // 1_000_000, _LAST_ORDER_MS + 1)
+    return str(_LAST_ORDER_MS)
 
 # ================== DATA MODELS ==================
-@dataclass
+@dataclass(slots=True)
 class Order:
     order_id: str
     user_id: int
@@ -132,13 +290,30 @@ class Order:
 
     group_message_id: Optional[int] = None
 
+_ORDER_FIELDS = tuple(f.name for f in fields(Order))
+
+def order_to_dict(o: Order) -> Dict[str, Any]:
+    # Order fields are flat scalars; no deep copy needed
+    return {name: getattr(o, name) for name in _ORDER_FIELDS}
+
 # ================== HELPERS ==================
 def is_allowed_group(update: Update) -> bool:
     chat = update.effective_chat
     return bool(chat and chat.id == ALLOWED_CHAT_ID)
 
 def is_admin(user_id: int) -> bool:
-    return (user_id in ADMIN_IDS) if ADMIN_IDS else False
+    return user_id in ADMIN_IDS
+
+# Handlers run concurrently (block=False); a per-user lock keeps one user's
+# updates in order while different users are served in parallel. Weak values:
+# a lock lives only while a handler holds or waits on it.
+_USER_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    lock = _USER_LOCKS.get(user_id)
+    if lock is None:
+        lock = _USER_LOCKS[user_id] = asyncio.Lock()
+    return lock
 
 def user_display(update: Update) -> Tuple[str, str]:
     u = update.effective_user
@@ -151,232 +326,377 @@ def user_display(update: Update) -> Tuple[str, str]:
 def maps_link(lat: float, lon: float) -> str:
     return f"https://maps.google.com/?q={lat},{lon}"
 
+# Rendered cards are memoized on the fields the card shows, so any change to
+# the order (stored or not) yields a new key and unchanged orders never re-render.
+CARD_CACHE_SIZE = 512
+_CARD_FIELDS = attrgetter(
+    "order_id", "status",
+    "pickup_text", "pickup_lat", "pickup_lon",
+    "drop_text", "drop_lat", "drop_lon",
+    "people", "when", "price_text", "phone", "username_confirm",
+    "driver_name", "driver_username",
+)
+
 def order_card_text(o: Order) -> str:
-    pickup = o.pickup_text
-    if o.pickup_lat is not None and o.pickup_lon is not None:
-        pickup += f"\n📍 Pickup: {maps_link(o.pickup_lat, o.pickup_lon)}"
-
-    drop = o.drop_text
-    if o.drop_lat is not None and o.drop_lon is not None:
-        drop += f"\n🏁 Dropoff: {maps_link(o.drop_lat, o.drop_lon)}"
-
-    contact_lines = []
-    if o.phone:
-        contact_lines.append(f"📞 Telefon: {o.phone}")
-    if o.username_confirm:
-        contact_lines.append(f"👤 Telegram: {o.username_confirm}")
-    contact_block = "\n".join(contact_lines) if contact_lines else "👤 Aloqa: (kiritilmagan)"
-
-    status_line = {
-        "posted": "Holat: ⏳ Haydovchi kutilmoqda",
-        "assigned": "Holat: ✅ Haydovchi biriktirildi",
-        "cancelled": "Holat: ❌ Bekor qilindi",
-        "pending": "Holat: 📝 To‘ldirilmoqda",
-    }.get(o.status, f"Holat: {o.status}")
-
-    driver_line = ""
-    if o.status == "assigned":
-        d = o.driver_username or o.driver_name or "Haydovchi"
-        driver_line = f"\n🚖 Haydovchi: {d}"
-
-    price_line = f"💰 Narx: {o.price_text or 'Kelishilgan narxda'}"
-
-    return (
-        "🚕 TAKSI BUYURTMA\n\n"
-        f"🆔 ID: {o.order_id}\n\n"
-        f"📍 Qayerdan:\n{pickup}\n\n"
-        f"🏁 Qayerga:\n{drop}\n\n"
-        f"👥 Odamlar: {o.people}\n"
-        f"⏰ Vaqt: {o.when}\n"
-        f"{price_line}\n\n"
-        f"{contact_block}\n\n"
-        f"{status_line}"
-        f"{driver_line}"
+    return render_order_card(_CARD_FIELDS(o))
+
+_CARD_HEADER = "🚕 TAKSI BUYURTMA\n\n🆔 ID: "
+_CARD_NO_CONTACT = "👤 Aloqa: (kiritilmagan)"
+_STATUS_LINES = {
+    "posted": "Holat: ⏳ Haydovchi kutilmoqda",
+    "assigned": "Holat: ✅ Haydovchi biriktirildi",
+    "cancelled": "Holat: ❌ Bekor qilindi",
+    "pending": "Holat: 📝 To‘ldirilmoqda",
+}
+
+@lru_cache(maxsize=CARD_CACHE_SIZE)
+def render_order_card(key: Tuple) -> str:
+    (order_id, status,
+     pickup_text, pickup_lat, pickup_lon,
+     drop_text, drop_lat, drop_lon,
+     people, when, price_text, phone, username_confirm,
+     driver_name, driver_username) = key
+
+    parts = [_CARD_HEADER, order_id, "\n\n📍 Qayerdan:\n", pickup_text]
+    if pickup_lat is not None and pickup_lon is not None:
+        parts += ("\n📍 Pickup: ", maps_link(pickup_lat, pickup_lon))
+
+    parts += ("\n\n🏁 Qayerga:\n", drop_text)
+    if drop_lat is not None and drop_lon is not None:
+        parts += ("\n🏁 Dropoff: ", maps_link(drop_lat, drop_lon))
+
+    parts += (
+        "\n\n👥 Odamlar: ", people,
+        "\n⏰ Vaqt: ", when,
+        "\n💰 Narx: ", price_text or "Kelishilgan narxda",
+        "\n\n",
     )
 
-def order_keyboard(o: Order) -> InlineKeyboardMarkup:
-    if o.status == "posted":
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Qabul qilish", callback_data=f"accept:{o.order_id}")],
-            [InlineKeyboardButton("❌ Bekor qilish (mijoz)", callback_data=f"cancel:{o.order_id}")],
-        ])
-    if o.status == "assigned":
+    if phone:
+        parts += ("📞 Telefon: ", phone)
+    if username_confirm:
+        if phone:
+            parts.append("\n")
+        parts += ("👤 Telegram: ", username_confirm)
+    if not phone and not username_confirm:
+        parts.append(_CARD_NO_CONTACT)
+
+    parts += ("\n\n", _STATUS_LINES.get(status) or f"Holat: {status}")
+
+    if status == "assigned":
+        parts += ("\n🚖 Haydovchi: ", driver_username or driver_name or "Haydovchi")
+
+    return "".join(parts)
+
+KB_CANCELLED = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Bekor qilingan", callback_data="noop")]])
+KB_EMPTY = InlineKeyboardMarkup([])
+
+# Live cards (posted/assigned) carry the order_id in callback_data, so they are
+# cached per (order_id, status); a status change simply stops hitting the old key.
+@lru_cache(maxsize=1024)
+def live_order_keyboard(order_id: str, status: str) -> InlineKeyboardMarkup:
+    if status == "posted":
         return InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔄 Haydovchi bekor qildi (qayta e’lon)", callback_data=f"driver_cancel:{o.order_id}")],
-            [InlineKeyboardButton("✅ Band", callback_data=f"noop:{o.order_id}")],
+            [InlineKeyboardButton("✅ Qabul qilish", callback_data=f"accept:{order_id}")],
+            [InlineKeyboardButton("❌ Bekor qilish (mijoz)", callback_data=f"cancel:{order_id}")],
         ])
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Haydovchi bekor qildi (qayta e’lon)", callback_data=f"driver_cancel:{order_id}")],
+        [InlineKeyboardButton("✅ Band", callback_data="noop")],
+    ])
+
+def order_keyboard(o: Order) -> InlineKeyboardMarkup:
+    if o.status in ("posted", "assigned"):
+        return live_order_keyboard(o.order_id, o.status)
     if o.status == "cancelled":
-        return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Bekor qilingan", callback_data=f"noop:{o.order_id}")]])
-    return InlineKeyboardMarkup([])
+        return KB_CANCELLED
+    return KB_EMPTY
 
-def get_user_step(user_id: int) -> str:
-    return (STATE.get("users", {}).get(str(user_id), {}) or {}).get("step", "")
+# Wizard step is transient: it lives in context.user_data (memory only). Orders
+# left "pending" by a restart are cancelled in on_startup.
+def get_user_step(context: ContextTypes.DEFAULT_TYPE) -> str:
+    return context.user_data.get("step", "")
 
-def set_user_step(user_id: int, step: str, order_id: Optional[str] = None) -> None:
-    users = STATE.setdefault("users", {})
-    users.setdefault(str(user_id), {})
-    users[str(user_id)]["step"] = step
+def set_user_step(context: ContextTypes.DEFAULT_TYPE, step: str, order_id: Optional[str] = None) -> None:
+    context.user_data["step"] = step
     if order_id is not None:
-        users[str(user_id)]["order_id"] = order_id
-    save_state(STATE)
-
-def get_user_order_id(user_id: int) -> Optional[str]:
-    return (STATE.get("users", {}).get(str(user_id), {}) or {}).get("order_id")
+        context.user_data["order_id"] = order_id
+
+def get_user_order_id(context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+    return context.user_data.get("order_id")
+
+def clear_user_step(context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data.pop("step", None)
+    context.user_data.pop("order_id", None)
+
+# Indexes over STATE["orders"], kept in sync by store_order
+_ACTIVE_BY_USER: Dict[int, Set[str]] = {}
+_POSTED: Set[str] = set()
+# posted/assigned order ids, ascending (order_id is a millisecond timestamp)
+_POSTED_OR_ASSIGNED: List[str] = []
+
+def index_order(order_id: str, user_id: int, status: str) -> None:
+    if status in ("pending", "posted", "assigned"):
+        _ACTIVE_BY_USER.setdefault(user_id, set()).add(order_id)
+    else:
+        oids = _ACTIVE_BY_USER.get(user_id)
+        if oids is not None:
+            oids.discard(order_id)
+            if not oids:
+                del _ACTIVE_BY_USER[user_id]
+
+    if status == "posted":
+        _POSTED.add(order_id)
+    else:
+        _POSTED.discard(order_id)
+
+    i = bisect_left(_POSTED_OR_ASSIGNED, order_id)
+    present = i < len(_POSTED_OR_ASSIGNED) and _POSTED_OR_ASSIGNED[i] == order_id
+    if status in ("posted", "assigned"):
+        if not present:
+            _POSTED_OR_ASSIGNED.insert(i, order_id)
+    elif present:
+        del _POSTED_OR_ASSIGNED[i]
+
+for _oid, _data in ORDERS.items():
+    index_order(_oid, _data.get("user_id"), _data.get("status"))
 
 def has_active_order(user_id: int) -> bool:
-    for o in STATE.get("orders", {}).values():
-        if o.get("user_id") == user_id and o.get("status") in ("pending", "posted", "assigned"):
-            return True
-    return False
+    return bool(_ACTIVE_BY_USER.get(user_id))
+
+# Live Order objects for recently used orders (LRU). STATE["orders"] stays the
+# source of truth; store_order writes through to both.
+ORDER_CACHE_SIZE = 256
+_ORDER_CACHE: "OrderedDict[str, Order]" = OrderedDict()
+
+def cache_order(o: Order) -> None:
+    if o.status == "cancelled":
+        _ORDER_CACHE.pop(o.order_id, None)
+        return
+    _ORDER_CACHE[o.order_id] = o
+    _ORDER_CACHE.move_to_end(o.order_id)
+    if len(_ORDER_CACHE) > ORDER_CACHE_SIZE:
+        _ORDER_CACHE.popitem(last=False)
 
 def store_order(o: Order) -> None:
-    STATE["orders"][o.order_id] = asdict(o)
-    save_state(STATE)
+    data = order_to_dict(o)
+    ORDERS[o.order_id] = data
+    _ORDER_JSON.pop(o.order_id, None)
+    log_delta("set", ["orders", o.order_id], data)
+    index_order(o.order_id, o.user_id, o.status)
+    cache_order(o)
 
 def load_order(order_id: str) -> Optional[Order]:
-    data = (STATE.get("orders", {}) or {}).get(order_id)
+    o = _ORDER_CACHE.get(order_id)
+    if o is not None:
+        _ORDER_CACHE.move_to_end(order_id)
+        return o
+    data = ORDERS.get(order_id)
     if not data:
         return None
-    return Order(**data)
+    o = Order(**data)
+    cache_order(o)
+    return o
 
 def update_order(o: Order) -> None:
     store_order(o)
 
-def delete_job(job_queue, name: str) -> None:
+# Apply several field changes with a single store (one WAL line).
+def update_order_fields(order_id: str, **changes) -> Optional[Order]:
+    o = load_order(order_id)
+    if not o:
+        return None
+    for k, v in changes.items():
+        setattr(o, k, v)
+    update_order(o)
+    return o
+
+# Check-and-set: no await between the status check and the write, so two
+# concurrent handlers can never both win the same transition.
+def cas_order_status(order_id: str, expected: str, **changes) -> Optional[Order]:
+    o = load_order(order_id)
+    if not o or o.status != expected:
+        return None
+    return update_order_fields(order_id, **changes)
+
+# Reminders: one sweep job reposts every posted order whose last group post is
+# older than the interval. posted order_id -> time.monotonic() of that post.
+REMIND_SWEEP_SEC = 30
+_LAST_POSTED: Dict[str, float] = {}
+
+# Best-effort Bot API call: one retry on a transient network error; "message is
+# not modified" is expected and stays silent. Flood control (RetryAfter) is
+# retried by the AIORateLimiter, so here it is only logged.
+async def safe_call(call, retries: int = 1):
     try:
-        jobs = job_queue.get_jobs_by_name(name)
-        for j in jobs:
-            j.schedule_removal()
-    except Exception:
-        pass
+        return await call()
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            log.warning("telegram bad request: %s", e)
+        return None
+    except (TimedOut, NetworkError) as e:
+        if not retries:
+            log.warning("telegram network error: %s", e)
+            return None
+    except TelegramError as e:
+        log.warning("telegram call failed: %s", e)
+        return None
+    return await safe_call(call, retries - 1)
+
+# What each posted group card currently shows: order_id -> (message_id, hash of
+# text + status; the keyboard is a function of status). Identical edits are
+# skipped. Dropped once the order leaves "posted", so the dict stays bounded.
+_SHOWN_CARD: Dict[str, Tuple[int, int]] = {}
 
-def remind_job_name(order_id: str) -> str:
-    return f"remind:{order_id}"
+def card_fingerprint(text: str, status: str) -> int:
+    return hash((text, status))
+
+# Static arguments of every group card send/edit, built once
+_GROUP_SEND_KW = {
+    "chat_id": ALLOWED_CHAT_ID,
+    "message_thread_id": TAXI_TOPIC_ID,
+    "disable_web_page_preview": True,
+}
+_GROUP_EDIT_KW = {"chat_id": ALLOWED_CHAT_ID, "disable_web_page_preview": True}
 
 async def post_order_to_group(context: ContextTypes.DEFAULT_TYPE, o: Order, delete_old: bool = False) -> Optional[int]:
+    # order guruhga chiqishidan oldin diskda bo'lsin
+    flush_wal()
+
+    # o umumiy (cache) obyekt — send davomida o'zgarishi mumkin, shuning uchun
+    # aynan yuborilgan holatni yozib qo'yamiz
+    text, markup = order_card_text(o), order_keyboard(o)
+    shown = card_fingerprint(text, o.status)
+    send = context.bot.send_message(text=text, reply_markup=markup, **_GROUP_SEND_KW)
     if delete_old and o.group_message_id:
-        try:
-            await context.bot.delete_message(chat_id=ALLOWED_CHAT_ID, message_id=o.group_message_id)
-        except Exception:
-            pass
-
-    sent = await context.bot.send_message(
-        chat_id=ALLOWED_CHAT_ID,
-        message_thread_id=TAXI_TOPIC_ID,
-        text=order_card_text(o),
-        reply_markup=order_keyboard(o),
-        disable_web_page_preview=True,
-    )
+        # eski kartani o'chirish va yangisini yuborish bir-biriga bog'liq emas — parallel
+        mid = o.group_message_id
+        _, sent = await asyncio.gather(
+            safe_call(lambda: context.bot.delete_message(chat_id=ALLOWED_CHAT_ID, message_id=mid)),
+            send,
+        )
+    else:
+        sent = await send
+    _SHOWN_CARD[o.order_id] = (sent.message_id, shown)
     return sent.message_id
 
-def schedule_reminder(app: Application, order_id: str) -> None:
-    if not app.job_queue:
-        return
-    name = remind_job_name(order_id)
-    delete_job(app.job_queue, name)
-    app.job_queue.run_repeating(
-        callback=reminder_tick,
-        interval=get_remind_every_sec(),
-        first=get_remind_every_sec(),
-        name=name,
-        data={"order_id": order_id},
-    )
+# After an awaited repost: the held Order may be stale (changed, or evicted from
+# the cache and replaced) by now, so reload it and store only the new message id.
+# If it stopped being "posted" during the send, the fresh card is corrected.
+async def finish_repost(context: ContextTypes.DEFAULT_TYPE, order_id: str, mid: int) -> Optional[Order]:
+    cur = update_order_fields(order_id, group_message_id=mid)
+    if cur and cur.status != "posted":
+        await edit_group_card(context, cur)
+    return cur
 
-def reschedule_all_posted(app: Application) -> None:
-    if not app.job_queue:
-        return
-    try:
-        for job in list(app.job_queue.jobs()):
-            if job.name and job.name.startswith("remind:"):
-                job.schedule_removal()
-    except Exception:
-        pass
+def schedule_reminder(order_id: str) -> None:
+    _LAST_POSTED[order_id] = time.monotonic()
 
-    for oid, data in (STATE.get("orders", {}) or {}).items():
-        if data.get("status") == "posted":
-            schedule_reminder(app, oid)
+def cancel_reminder(order_id: str) -> None:
+    _LAST_POSTED.pop(order_id, None)
+
+def reschedule_all_posted() -> None:
+    _LAST_POSTED.clear()
+    for oid in _POSTED:
+        schedule_reminder(oid)
 
 # ================== DM FLOW UI ==================
+KB_REQUEST_LOCATION = ReplyKeyboardMarkup(
+    [[KeyboardButton("📍 Lokatsiya yuborish", request_location=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+
 def kb_request_location() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton("📍 Lokatsiya yuborish", request_location=True)]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+    return KB_REQUEST_LOCATION
+
+KB_REQUEST_CONTACT = ReplyKeyboardMarkup(
+    [[KeyboardButton("📞 Telefon raqamni yuborish", request_contact=True)],
+     [KeyboardButton("⏭ O‘tkazib yuborish")]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
 
 def kb_request_contact() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton("📞 Telefon raqamni yuborish", request_contact=True)],
-         [KeyboardButton("⏭ O‘tkazib yuborish")]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+    return KB_REQUEST_CONTACT
+
+KB_PEOPLE = ReplyKeyboardMarkup(
+    [[KeyboardButton("1"), KeyboardButton("2"), KeyboardButton("3"), KeyboardButton("4")],
+     [KeyboardButton("5+"), KeyboardButton("⛔ Bekor qilish")]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
 
 def kb_people() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton("1"), KeyboardButton("2"), KeyboardButton("3"), KeyboardButton("4")],
-         [KeyboardButton("5+"), KeyboardButton("⛔ Bekor qilish")]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+    return KB_PEOPLE
+
+KB_WHEN = ReplyKeyboardMarkup(
+    [[KeyboardButton("Hozir"), KeyboardButton("Vaqt yozaman")],
+     [KeyboardButton("⛔ Bekor qilish")]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
 
 def kb_when() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton("Hozir"), KeyboardButton("Vaqt yozaman")],
-         [KeyboardButton("⛔ Bekor qilish")]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+    return KB_WHEN
+
+# Answers accepted as text in the wizard
+_PEOPLE_OPTIONS = frozenset({"1", "2", "3", "4", "5+"})
+_NEGATIVE_ANSWERS = frozenset({"yoq", "yo'q", "yo‘q", "yoq.", "yo'q."})
 
 # ================== ADMIN PANEL (NEW) ==================
 def admin_menu_text() -> str:
     cur_int = get_remind_every_sec() // 60
     cur_price = get_default_price_text()
-    return (
-        "🛠 ADMIN PANEL\n\n"
-        f"⏱ Interval: {cur_int} daqiqa\n"
-        f"💰 Default narx: {cur_price}\n\n"
-        "Tanlang:"
-    )
+    return "".join((
+        "🛠 ADMIN PANEL\n\n⏱ Interval: ", str(cur_int),
+        " daqiqa\n💰 Default narx: ", cur_price,
+        "\n\nTanlang:",
+    ))
+
+ADMIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⏱ Interval", callback_data="adm:interval")],
+    [InlineKeyboardButton("💰 Default narx", callback_data="adm:price")],
+    [InlineKeyboardButton("📋 Aktiv buyurtmalar", callback_data="adm:orders")],
+])
 
 def admin_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("⏱ Interval", callback_data="adm:interval")],
-        [InlineKeyboardButton("💰 Default narx", callback_data="adm:price")],
-        [InlineKeyboardButton("📋 Aktiv buyurtmalar", callback_data="adm:orders")],
-    ])
+    return ADMIN_MENU_KB
+
+INTERVAL_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("5m", callback_data="adm:setint:5"),
+        InlineKeyboardButton("10m", callback_data="adm:setint:10"),
+        InlineKeyboardButton("15m", callback_data="adm:setint:15"),
+        InlineKeyboardButton("30m", callback_data="adm:setint:30"),
+    ],
+    [InlineKeyboardButton("⬅️ Orqaga", callback_data="adm:menu")],
+])
 
 def interval_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("5m", callback_data="adm:setint:5"),
-            InlineKeyboardButton("10m", callback_data="adm:setint:10"),
-            InlineKeyboardButton("15m", callback_data="adm:setint:15"),
-            InlineKeyboardButton("30m", callback_data="adm:setint:30"),
-        ],
-        [InlineKeyboardButton("⬅️ Orqaga", callback_data="adm:menu")],
-    ])
+    return INTERVAL_KB
+
+PRICE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Kelishilgan narxda", callback_data="adm:setprice:Kelishilgan narxda")],
+    [InlineKeyboardButton("20 SAR", callback_data="adm:setprice:20 SAR"),
+     InlineKeyboardButton("30 SAR", callback_data="adm:setprice:30 SAR")],
+    [InlineKeyboardButton("⬅️ Orqaga", callback_data="adm:menu")],
+])
 
 def price_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Kelishilgan narxda", callback_data="adm:setprice:Kelishilgan narxda")],
-        [InlineKeyboardButton("20 SAR", callback_data="adm:setprice:20 SAR"),
-         InlineKeyboardButton("30 SAR", callback_data="adm:setprice:30 SAR")],
-        [InlineKeyboardButton("⬅️ Orqaga", callback_data="adm:menu")],
-    ])
+    return PRICE_KB
 
 def active_orders_list() -> List[Order]:
     items = []
-    for oid, data in (STATE.get("orders", {}) or {}).items():
-        st = data.get("status")
-        if st in ("posted", "assigned"):
-            try:
-                items.append(Order(**data))
-            except Exception:
-                pass
     # newest first
-    items.sort(key=lambda x: x.order_id, reverse=True)
-    return items[:10]
+    for oid in reversed(_POSTED_OR_ASSIGNED[-10:]):
+        try:
+            o = load_order(oid)
+        except Exception:
+            continue
+        if o:
+            items.append(o)
+    return items
 
 def orders_kb(orders: List[Order]) -> InlineKeyboardMarkup:
     rows = []
@@ -400,101 +720,100 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.effective_message.reply_text(admin_menu_text(), reply_markup=admin_menu_kb())
 
-async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    if not q or not q.data:
-        return
-    uid = q.from_user.id if q.from_user else 0
-    if not is_admin(uid):
-        await q.answer()
-        return
+async def adm_menu(q, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await q.edit_message_text(admin_menu_text(), reply_markup=admin_menu_kb())
 
-    await q.answer()
-    data = q.data
+async def adm_interval(q, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await q.edit_message_text("⏱ Intervalni tanlang:", reply_markup=interval_kb())
 
-    if data == "adm:menu":
-        await q.edit_message_text(admin_menu_text(), reply_markup=admin_menu_kb())
-        return
+async def adm_setint(q, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    mins = int(arg)
+    set_remind_every_min(mins)
+    reschedule_all_posted()
+    await q.edit_message_text(f"✅ Interval {mins} daqiqaga o‘zgardi.", reply_markup=admin_menu_kb())
 
-    if data == "adm:interval":
-        await q.edit_message_text("⏱ Intervalni tanlang:", reply_markup=interval_kb())
-        return
+async def adm_price(q, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await q.edit_message_text("💰 Default narxni tanlang:", reply_markup=price_kb())
 
-    if data.startswith("adm:setint:"):
-        mins = int(data.split(":", 2)[2])
-        set_remind_every_min(mins)
-        reschedule_all_posted(context.application)
-        await q.edit_message_text(f"✅ Interval {mins} daqiqaga o‘zgardi.", reply_markup=admin_menu_kb())
-        return
+async def adm_setprice(q, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    set_default_price_text(arg)
+    await q.edit_message_text(f"✅ Default narx: {get_default_price_text()}", reply_markup=admin_menu_kb())
 
-    if data == "adm:price":
-        await q.edit_message_text("💰 Default narxni tanlang:", reply_markup=price_kb())
+async def adm_orders(q, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    orders = active_orders_list()
+    if not orders:
+        await q.edit_message_text("Hozir aktiv buyurtma yo‘q.", reply_markup=admin_menu_kb())
         return
+    await q.edit_message_text("📋 Aktiv buyurtmalar:", reply_markup=orders_kb(orders))
 
-    if data.startswith("adm:setprice:"):
-        txt = data.split(":", 2)[2]
-        set_default_price_text(txt)
-        await q.edit_message_text(f"✅ Default narx: {get_default_price_text()}", reply_markup=admin_menu_kb())
+async def adm_order(q, context: ContextTypes.DEFAULT_TYPE, order_id: str):
+    o = load_order(order_id)
+    if not o:
+        await q.edit_message_text("Order topilmadi.", reply_markup=admin_menu_kb())
         return
+    await q.edit_message_text(order_card_text(o), reply_markup=order_admin_kb(order_id), disable_web_page_preview=True)
 
-    if data == "adm:orders":
-        orders = active_orders_list()
-        if not orders:
-            await q.edit_message_text("Hozir aktiv buyurtma yo‘q.", reply_markup=admin_menu_kb())
-            return
-        await q.edit_message_text("📋 Aktiv buyurtmalar:", reply_markup=orders_kb(orders))
+async def adm_repost(q, context: ContextTypes.DEFAULT_TYPE, order_id: str):
+    o = load_order(order_id)
+    if not o or o.status != "posted":
+        await q.edit_message_text("Bu order repost uchun aktiv emas (posted bo‘lishi kerak).", reply_markup=admin_menu_kb())
+        return
+    try:
+        mid = await post_order_to_group(context, o, delete_old=True)
+    except Exception:
+        log.exception("admin repost failed")
+        schedule_reminder(order_id)  # sweep keyinroq qayta urinadi
+        await q.edit_message_text("Qayta e’lon qilishda xatolik.", reply_markup=admin_menu_kb())
         return
 
-    if data.startswith("adm:order:"):
-        order_id = data.split(":", 2)[2]
-        o = load_order(order_id)
-        if not o:
-            await q.edit_message_text("Order topilmadi.", reply_markup=admin_menu_kb())
-            return
-        await q.edit_message_text(order_card_text(o), reply_markup=order_admin_kb(order_id), disable_web_page_preview=True)
+    cur = await finish_repost(context, order_id, mid)
+    if not cur or cur.status != "posted":
+        status = cur.status if cur else "?"
+        await q.edit_message_text(f"Yuborish paytida order holati o‘zgardi: {status}.", reply_markup=admin_menu_kb())
         return
+    schedule_reminder(order_id)
+    await q.edit_message_text("✅ Qayta e’lon qilindi.", reply_markup=admin_menu_kb())
 
-    if data.startswith("adm:repost:"):
-        order_id = data.split(":", 2)[2]
-        o = load_order(order_id)
-        if not o or o.status != "posted":
-            await q.edit_message_text("Bu order repost uchun aktiv emas (posted bo‘lishi kerak).", reply_markup=admin_menu_kb())
-            return
-        try:
-            mid = await post_order_to_group(context, o, delete_old=True)
-            o.group_message_id = mid
-            update_order(o)
-        except Exception:
-            log.exception("admin repost failed")
-        schedule_reminder(context.application, o.order_id)
-        await q.edit_message_text("✅ Qayta e’lon qilindi.", reply_markup=admin_menu_kb())
+async def adm_cancel(q, context: ContextTypes.DEFAULT_TYPE, order_id: str):
+    o = load_order(order_id)
+    if not o:
+        await q.edit_message_text("Order topilmadi.", reply_markup=admin_menu_kb())
         return
+    o.status = "cancelled"
+    update_order(o)
+    cancel_reminder(order_id)
+    await edit_group_card(context, o)
+    await q.edit_message_text("✅ Admin buyurtmani bekor qildi.", reply_markup=admin_menu_kb())
+
+# "adm:<action>[:<arg>]" -> handler(q, context, arg)
+ADMIN_ACTIONS = {
+    "menu": adm_menu,
+    "interval": adm_interval,
+    "setint": adm_setint,
+    "price": adm_price,
+    "setprice": adm_setprice,
+    "orders": adm_orders,
+    "order": adm_order,
+    "repost": adm_repost,
+    "cancel": adm_cancel,
+}
 
-    if data.startswith("adm:cancel:"):
-        order_id = data.split(":", 2)[2]
-        o = load_order(order_id)
-        if not o:
-            await q.edit_message_text("Order topilmadi.", reply_markup=admin_menu_kb())
-            return
-        o.status = "cancelled"
-        update_order(o)
-        if context.job_queue:
-            delete_job(context.job_queue, remind_job_name(order_id))
-        try:
-            if o.group_message_id:
-                await context.bot.edit_message_text(
-                    chat_id=ALLOWED_CHAT_ID,
-                    message_id=o.group_message_id,
-                    message_thread_id=TAXI_TOPIC_ID,
-                    text=order_card_text(o),
-                    reply_markup=order_keyboard(o),
-                    disable_web_page_preview=True,
-                )
-        except Exception:
-            pass
-        await q.edit_message_text("✅ Admin buyurtmani bekor qildi.", reply_markup=admin_menu_kb())
+async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not q or not q.data:
+        return
+    uid = q.from_user.id if q.from_user else 0
+    if not is_admin(uid):
+        await q.answer()
         return
 
+    await q.answer()
+    parts = q.data.split(":", 2)
+    handler = ADMIN_ACTIONS.get(parts[1]) if len(parts) > 1 else None
+    if handler:
+        async with user_lock(uid):
+            await handler(q, context, parts[2] if len(parts) > 2 else "")
+
 # ================== COMMANDS ==================
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat and update.effective_chat.type == ChatType.PRIVATE:
@@ -507,9 +826,12 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_chat or update.effective_chat.type != ChatType.PRIVATE:
         return
-    uid = update.effective_user.id
-    oid = get_user_order_id(uid)
-    step = get_user_step(uid)
+    async with user_lock(update.effective_user.id):
+        await cancel_flow(update, context)
+
+async def cancel_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    oid = get_user_order_id(context)
+    step = get_user_step(context)
     if not step or not oid:
         await update.effective_message.reply_text("Bekor qilinadigan jarayon yo‘q.", reply_markup=ReplyKeyboardRemove())
         return
@@ -519,10 +841,7 @@ async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         o.status = "cancelled"
         update_order(o)
 
-    set_user_step(uid, "", None)
-    STATE["users"].setdefault(str(uid), {})
-    STATE["users"][str(uid)].pop("order_id", None)
-    save_state(STATE)
+    clear_user_step(context)
 
     await update.effective_message.reply_text("Jarayon bekor qilindi.", reply_markup=ReplyKeyboardRemove())
 
@@ -551,38 +870,38 @@ async def taxi_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if chat.type == ChatType.PRIVATE:
         uid = update.effective_user.id
+        async with user_lock(uid):
+            if has_active_order(uid):
+                await update.effective_message.reply_text(
+                    "Sizda aktiv buyurtma bor. Avval uni yakunlang yoki /cancel qiling."
+                )
+                return
 
-        if has_active_order(uid):
-            await update.effective_message.reply_text(
-                "Sizda aktiv buyurtma bor. Avval uni yakunlang yoki /cancel qiling."
+            name, username = user_display(update)
+            oid = new_order_id()
+
+            o = Order(
+                order_id=oid,
+                user_id=uid,
+                user_name=name or "User",
+                user_username=username or "",
+                pickup_text="",
+                drop_text="",
+                people="",
+                when="",
+                phone="",
+                username_confirm=username or "",
+                price_text=get_default_price_text(),   # ✅ admin panel default narxi shu yerda ishlaydi
+                status="pending",
             )
-            return
-
-        name, username = user_display(update)
-        oid = new_order_id()
-
-        o = Order(
-            order_id=oid,
-            user_id=uid,
-            user_name=name or "User",
-            user_username=username or "",
-            pickup_text="",
-            drop_text="",
-            people="",
-            when="",
-            phone="",
-            username_confirm=username or "",
-            price_text=get_default_price_text(),   # ✅ admin panel default narxi shu yerda ishlaydi
-            status="pending",
-        )
-        store_order(o)
+            store_order(o)
 
-        set_user_step(uid, "pickup_location", oid)
+            set_user_step(context, "pickup_location", oid)
 
-        await update.effective_message.reply_text(
-            "📍 Qayerdasiz?\nLokatsiyani yuboring.",
-            reply_markup=kb_request_location(),
-        )
+            await update.effective_message.reply_text(
+                "📍 Qayerdasiz?\nLokatsiyani yuboring.",
+                reply_markup=kb_request_location(),
+            )
 
 # ================== ADMIN COMMANDS (OLD) ==================
 async def setinterval_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -602,7 +921,7 @@ async def setinterval_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     set_remind_every_min(minutes)
-    reschedule_all_posted(context.application)
+    reschedule_all_posted()
 
     await update.effective_message.reply_text(f"✅ Reminder interval: {max(1, minutes)} daqiqaga o‘zgardi.")
 
@@ -626,384 +945,476 @@ async def setprice_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     o.price_text = price_text if price_text else "Kelishilgan narxda"
     update_order(o)
 
-    if o.group_message_id and o.status in ("posted", "assigned"):
-        try:
-            await context.bot.edit_message_text(
-                chat_id=ALLOWED_CHAT_ID,
-                message_id=o.group_message_id,
-                message_thread_id=TAXI_TOPIC_ID,
-                text=order_card_text(o),
-                reply_markup=order_keyboard(o),
-                disable_web_page_preview=True,
-            )
-        except Exception:
-            pass
+    if o.status in ("posted", "assigned"):
+        await edit_group_card(context, o)
 
     await update.effective_message.reply_text(f"✅ Narx yangilandi: {o.price_text}")
 
 # ================== PRIVATE MESSAGE ROUTER ==================
-async def private_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.effective_chat or update.effective_chat.type != ChatType.PRIVATE:
+async def step_pickup_location(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.location:
+        o.pickup_lat = msg.location.latitude
+        o.pickup_lon = msg.location.longitude
+        o.pickup_text = "Lokatsiya yuborildi"
+        update_order(o)
+        set_user_step(context, "pickup_text")
+        await msg.reply_text("Pickup joyni qisqa yozing (misol: Masjid Nabaviy, Gate 25):", reply_markup=ReplyKeyboardRemove())
         return
+    await msg.reply_text("Iltimos, lokatsiya yuboring.", reply_markup=kb_request_location())
 
-    msg = update.effective_message
-    if not msg:
+async def step_pickup_text(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.text and msg.text.strip():
+        o.pickup_text = msg.text.strip()
+        update_order(o)
+        set_user_step(context, "drop_choice")
+        await msg.reply_text("🏁 Qayerga borasiz?\nLokatsiya yuborsangiz ham bo‘ladi, yoki matn bilan yozing.")
         return
+    await msg.reply_text("Pickup joyni matn bilan yozing.")
 
-    uid = update.effective_user.id
-    step = get_user_step(uid)
-    oid = get_user_order_id(uid)
-
-    if not step or not oid:
+async def step_drop_choice(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.location:
+        o.drop_lat = msg.location.latitude
+        o.drop_lon = msg.location.longitude
+        o.drop_text = "Lokatsiya yuborildi"
+        update_order(o)
+        set_user_step(context, "drop_text")
+        await msg.reply_text("Dropoff joyni qisqa yozing (misol: Madina Airport):")
         return
 
-    o = load_order(oid)
-    if not o:
-        set_user_step(uid, "", None)
+    if msg.text and msg.text.strip():
+        o.drop_text = msg.text.strip()
+        update_order(o)
+        set_user_step(context, "people")
+        await msg.reply_text("👥 Nechta odam?", reply_markup=kb_people())
         return
 
-    if msg.text and msg.text.strip() == "⛔ Bekor qilish":
-        await cancel_cmd(update, context)
+    await msg.reply_text("Dropoff uchun lokatsiya yuboring yoki matn yozing.")
+
+async def step_drop_text(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.text and msg.text.strip():
+        o.drop_text = msg.text.strip()
+        update_order(o)
+        set_user_step(context, "people")
+        await msg.reply_text("👥 Nechta odam?", reply_markup=kb_people())
         return
+    await msg.reply_text("Dropoff joyni matn bilan yozing.")
 
-    if step == "pickup_location":
-        if msg.location:
-            o.pickup_lat = msg.location.latitude
-            o.pickup_lon = msg.location.longitude
-            o.pickup_text = "Lokatsiya yuborildi"
-            update_order(o)
-            set_user_step(uid, "pickup_text", oid)
-            await msg.reply_text("Pickup joyni qisqa yozing (misol: Masjid Nabaviy, Gate 25):", reply_markup=ReplyKeyboardRemove())
-            return
-        await msg.reply_text("Iltimos, lokatsiya yuboring.", reply_markup=kb_request_location())
+async def step_people(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.text and msg.text.strip() in _PEOPLE_OPTIONS:
+        o.people = msg.text.strip()
+        update_order(o)
+        set_user_step(context, "when")
+        await msg.reply_text("⏰ Qachon?", reply_markup=kb_when())
         return
+    await msg.reply_text("Iltimos, tugmalardan birini tanlang.", reply_markup=kb_people())
 
-    if step == "pickup_text":
-        if msg.text and msg.text.strip():
-            o.pickup_text = msg.text.strip()
-            update_order(o)
-            set_user_step(uid, "drop_choice", oid)
-            await msg.reply_text("🏁 Qayerga borasiz?\nLokatsiya yuborsangiz ham bo‘ladi, yoki matn bilan yozing.")
-            return
-        await msg.reply_text("Pickup joyni matn bilan yozing.")
+async def step_when(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.text and msg.text.strip() == "Hozir":
+        o.when = "Hozir"
+        update_order(o)
+        set_user_step(context, "phone")
+        await msg.reply_text("📞 Telefon raqamni yuboring (yoki o‘tkazib yuboring):", reply_markup=kb_request_contact())
         return
 
-    if step == "drop_choice":
-        if msg.location:
-            o.drop_lat = msg.location.latitude
-            o.drop_lon = msg.location.longitude
-            o.drop_text = "Lokatsiya yuborildi"
-            update_order(o)
-            set_user_step(uid, "drop_text", oid)
-            await msg.reply_text("Dropoff joyni qisqa yozing (misol: Madina Airport):")
-            return
+    if msg.text and msg.text.strip() == "Vaqt yozaman":
+        set_user_step(context, "when_text")
+        await msg.reply_text("Vaqtni yozing (misol: 18:30):", reply_markup=ReplyKeyboardRemove())
+        return
 
-        if msg.text and msg.text.strip():
-            o.drop_text = msg.text.strip()
-            update_order(o)
-            set_user_step(uid, "people", oid)
-            await msg.reply_text("👥 Nechta odam?", reply_markup=kb_people())
-            return
+    await msg.reply_text("Iltimos, tugmalardan tanlang.", reply_markup=kb_when())
 
-        await msg.reply_text("Dropoff uchun lokatsiya yuboring yoki matn yozing.")
+async def step_when_text(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.text and msg.text.strip():
+        o.when = msg.text.strip()
+        update_order(o)
+        set_user_step(context, "phone")
+        await msg.reply_text("📞 Telefon raqamni yuboring (yoki o‘tkazib yuboring):", reply_markup=kb_request_contact())
         return
+    await msg.reply_text("Vaqtni matn bilan yozing (misol: 18:30).")
 
-    if step == "drop_text":
-        if msg.text and msg.text.strip():
-            o.drop_text = msg.text.strip()
-            update_order(o)
-            set_user_step(uid, "people", oid)
-            await msg.reply_text("👥 Nechta odam?", reply_markup=kb_people())
-            return
-        await msg.reply_text("Dropoff joyni matn bilan yozing.")
+async def step_phone(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.contact and msg.contact.phone_number:
+        o.phone = msg.contact.phone_number
+        update_order(o)
+        set_user_step(context, "username_confirm")
+        await msg.reply_text("Telegram username’ni yozing (misol: @aliatt0r). Agar yo‘q bo‘lsa: yo‘q", reply_markup=ReplyKeyboardRemove())
         return
 
-    if step == "people":
-        if msg.text and msg.text.strip() in {"1", "2", "3", "4", "5+"}:
-            o.people = msg.text.strip()
-            update_order(o)
-            set_user_step(uid, "when", oid)
-            await msg.reply_text("⏰ Qachon?", reply_markup=kb_when())
-            return
-        await msg.reply_text("Iltimos, tugmalardan birini tanlang.", reply_markup=kb_people())
+    if msg.text and msg.text.strip() == "⏭ O‘tkazib yuborish":
+        o.phone = ""
+        update_order(o)
+        set_user_step(context, "username_confirm")
+        await msg.reply_text("Telegram username’ni yozing (misol: @aliatt0r). Agar yo‘q bo‘lsa: yo‘q", reply_markup=ReplyKeyboardRemove())
         return
 
-    if step == "when":
-        if msg.text and msg.text.strip() == "Hozir":
-            o.when = "Hozir"
-            update_order(o)
-            set_user_step(uid, "phone", oid)
-            await msg.reply_text("📞 Telefon raqamni yuboring (yoki o‘tkazib yuboring):", reply_markup=kb_request_contact())
-            return
+    if msg.text and msg.text.strip():
+        o.phone = msg.text.strip()
+        update_order(o)
+        set_user_step(context, "username_confirm")
+        await msg.reply_text("Telegram username’ni yozing (misol: @aliatt0r). Agar yo‘q bo‘lsa: yo‘q", reply_markup=ReplyKeyboardRemove())
+        return
 
-        if msg.text and msg.text.strip() == "Vaqt yozaman":
-            set_user_step(uid, "when_text", oid)
-            await msg.reply_text("Vaqtni yozing (misol: 18:30):", reply_markup=ReplyKeyboardRemove())
-            return
+    await msg.reply_text("Telefon raqam yuboring yoki o‘tkazib yuboring.", reply_markup=kb_request_contact())
 
-        await msg.reply_text("Iltimos, tugmalardan tanlang.", reply_markup=kb_when())
-        return
+async def step_username_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, msg, o: Order):
+    if msg.text and msg.text.strip():
+        txt = msg.text.strip()
+        if txt.lower() in _NEGATIVE_ANSWERS:
+            o.username_confirm = ""
+        else:
+            if not txt.startswith("@"):
+                txt = "@" + txt
+            o.username_confirm = txt
 
-    if step == "when_text":
-        if msg.text and msg.text.strip():
-            o.when = msg.text.strip()
-            update_order(o)
-            set_user_step(uid, "phone", oid)
-            await msg.reply_text("📞 Telefon raqamni yuboring (yoki o‘tkazib yuboring):", reply_markup=kb_request_contact())
-            return
-        await msg.reply_text("Vaqtni matn bilan yozing (misol: 18:30).")
-        return
+        o.status = "posted"
+        update_order(o)
 
-    if step == "phone":
-        if msg.contact and msg.contact.phone_number:
-            o.phone = msg.contact.phone_number
+        try:
+            mid = await post_order_to_group(context, o, delete_old=False)
+            o.group_message_id = mid
             update_order(o)
-            set_user_step(uid, "username_confirm", oid)
-            await msg.reply_text("Telegram username’ni yozing (misol: @aliatt0r). Agar yo‘q bo‘lsa: yo‘q", reply_markup=ReplyKeyboardRemove())
+        except Exception:
+            log.exception("send order to group failed")
+            await msg.reply_text("Xatolik: buyurtmani guruhga yuborib bo‘lmadi. Admin bilan bog‘laning.")
+            clear_user_step(context)
             return
 
-        if msg.text and msg.text.strip() == "⏭ O‘tkazib yuborish":
-            o.phone = ""
-            update_order(o)
-            set_user_step(uid, "username_confirm", oid)
-            await msg.reply_text("Telegram username’ni yozing (misol: @aliatt0r). Agar yo‘q bo‘lsa: yo‘q", reply_markup=ReplyKeyboardRemove())
-            return
+        schedule_reminder(o.order_id)
 
-        if msg.text and msg.text.strip():
-            o.phone = msg.text.strip()
-            update_order(o)
-            set_user_step(uid, "username_confirm", oid)
-            await msg.reply_text("Telegram username’ni yozing (misol: @aliatt0r). Agar yo‘q bo‘lsa: yo‘q", reply_markup=ReplyKeyboardRemove())
-            return
+        await msg.reply_text(
+            "✅ Buyurtmangiz taksi bo‘limiga yuborildi.\n"
+            "Haydovchi topilishi bilan sizga xabar beraman.",
+            reply_markup=ReplyKeyboardRemove(),
+        )
 
-        await msg.reply_text("Telefon raqam yuboring yoki o‘tkazib yuboring.", reply_markup=kb_request_contact())
+        clear_user_step(context)
         return
 
-    if step == "username_confirm":
-        if msg.text and msg.text.strip():
-            txt = msg.text.strip()
-            if txt.lower() in {"yoq", "yo'q", "yo‘q", "yoq.", "yo'q."}:
-                o.username_confirm = ""
-            else:
-                if not txt.startswith("@"):
-                    txt = "@" + txt
-                o.username_confirm = txt
+    await msg.reply_text("Username yozing (misol: @aliatt0r) yoki 'yo‘q' deb yozing.")
+
+# user step -> handler(update, context, msg, o)
+STEP_HANDLERS = {
+    "pickup_location": step_pickup_location,
+    "pickup_text": step_pickup_text,
+    "drop_choice": step_drop_choice,
+    "drop_text": step_drop_text,
+    "people": step_people,
+    "when": step_when,
+    "when_text": step_when_text,
+    "phone": step_phone,
+    "username_confirm": step_username_confirm,
+}
 
-            update_order(o)
+async def private_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_chat or update.effective_chat.type != ChatType.PRIVATE:
+        return
 
-            o.status = "posted"
-            update_order(o)
+    msg = update.effective_message
+    if not msg:
+        return
 
-            try:
-                mid = await post_order_to_group(context, o, delete_old=False)
-                o.group_message_id = mid
-                update_order(o)
-            except Exception:
-                log.exception("send order to group failed")
-                await msg.reply_text("Xatolik: buyurtmani guruhga yuborib bo‘lmadi. Admin bilan bog‘laning.")
-                set_user_step(uid, "", None)
-                return
+    async with user_lock(update.effective_user.id):
+        step = get_user_step(context)
+        oid = get_user_order_id(context)
 
-            schedule_reminder(context.application, o.order_id)
+        if not step or not oid:
+            return
 
-            await msg.reply_text(
-                "✅ Buyurtmangiz taksi bo‘limiga yuborildi.\n"
-                "Haydovchi topilishi bilan sizga xabar beraman.",
-                reply_markup=ReplyKeyboardRemove(),
-            )
+        o = load_order(oid)
+        if not o:
+            clear_user_step(context)
+            return
 
-            set_user_step(uid, "", None)
-            STATE["users"].setdefault(str(uid), {})
-            STATE["users"][str(uid)].pop("order_id", None)
-            save_state(STATE)
+        if msg.text and msg.text.strip() == "⛔ Bekor qilish":
+            await cancel_flow(update, context)
             return
 
-        await msg.reply_text("Username yozing (misol: @aliatt0r) yoki 'yo‘q' deb yozing.")
-        return
+        handler = STEP_HANDLERS.get(step)
+        if handler:
+            await handler(update, context, msg, o)
 
 # ================== REMINDER JOB ==================
 async def reminder_tick(context: ContextTypes.DEFAULT_TYPE):
-    order_id = (context.job.data or {}).get("order_id")
-    if not order_id:
+    now = time.monotonic()
+    every = get_remind_every_sec()
+    due = [oid for oid, ts in _LAST_POSTED.items() if now - ts >= every]
+    if not due:
         return
 
-    o = load_order(order_id)
-    if not o:
-        delete_job(context.job_queue, remind_job_name(order_id))
-        return
+    async def repost(order_id: str) -> None:
+        o = load_order(order_id)
+        # ✅ cancelled/assigned bo'lsa — reminder STOP
+        if not o or o.status != "posted":
+            cancel_reminder(order_id)
+            return
+        _LAST_POSTED[order_id] = now
+        try:
+            mid = await post_order_to_group(context, o, delete_old=True)
+        except Exception:
+            log.exception("reminder repost failed")
+            return
+        await finish_repost(context, order_id, mid)
 
-    # ✅ cancelled/assigned bo'lsa — reminder STOP
-    if o.status != "posted":
-        delete_job(context.job_queue, remind_job_name(order_id))
-        return
-
-    try:
-        mid = await post_order_to_group(context, o, delete_old=True)
-        o.group_message_id = mid
-        update_order(o)
-    except Exception:
-        log.exception("reminder repost failed")
+    # sur'atni AIORateLimiter boshqaradi (guruhga 20 msg/min), bu yerda cheklov yo'q
+    await asyncio.gather(*(repost(oid) for oid in due))
 
 # ================== CALLBACKS (GROUP BUTTONS) ==================
-async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    if not q or not q.data:
+# Group card edits are coalesced per order: bursts of clicks on the same card
+# (accept races, cancel + admin edits) collapse into one edit, made from the
+# order's current state when the window closes.
+EDIT_COALESCE_SEC = 0.2
+_EDIT_PENDING: Set[str] = set()
+
+async def edit_group_card(context: ContextTypes.DEFAULT_TYPE, o: Order) -> None:
+    if not o.group_message_id or o.order_id in _EDIT_PENDING:
         return
-    await q.answer()
+    _EDIT_PENDING.add(o.order_id)
+    context.application.create_task(flush_card_edit(context, o.order_id))
 
-    # faqat allowed group + taxi topic ichida ishlasin
-    if not q.message or not q.message.chat:
+async def flush_card_edit(context: ContextTypes.DEFAULT_TYPE, order_id: str) -> None:
+    await asyncio.sleep(EDIT_COALESCE_SEC)
+    _EDIT_PENDING.discard(order_id)
+    o = load_order(order_id)
+    if not o or not o.group_message_id:
         return
-    if q.message.chat.id != ALLOWED_CHAT_ID:
+    mid, status = o.group_message_id, o.status
+    text, markup = order_card_text(o), order_keyboard(o)
+    shown = (mid, card_fingerprint(text, status))
+    if _SHOWN_CARD.get(order_id) == shown:
         return
-    if getattr(q.message, "message_thread_id", None) != TAXI_TOPIC_ID:
+    sent = await safe_call(lambda: context.bot.edit_message_text(
+        message_id=mid,
+        text=text,
+        reply_markup=markup,
+        **_GROUP_EDIT_KW,
+    ))
+    if status != "posted":
+        # assigned/cancelled kartalar kam tahrirlanadi — yozuv saqlanmaydi
+        _SHOWN_CARD.pop(order_id, None)
+    elif sent:
+        _SHOWN_CARD[order_id] = shown
+
+async def notify_user(context: ContextTypes.DEFAULT_TYPE, user_id: int, text: str) -> None:
+    await safe_call(lambda: context.bot.send_message(chat_id=user_id, text=text))
+
+async def cb_cancel(q, context: ContextTypes.DEFAULT_TYPE, o: Order):
+    if q.from_user.id != o.user_id:
+        await q.answer("Bekor qilish faqat buyurtmachiga mumkin.", show_alert=True)
         return
-
-    if ":" not in q.data:
+    if o.status in ("cancelled",):
+        await q.answer("Allaqachon bekor qilingan.", show_alert=True)
+        return
+    if o.status == "assigned":
+        await q.answer("Haydovchi biriktirilgan. Bekor qilib bo‘lmaydi.", show_alert=True)
         return
 
-    action, order_id = q.data.split(":", 1)
-    o = load_order(order_id)
+    o.status = "cancelled"
+    update_order(o)
+    cancel_reminder(o.order_id)
+    await q.answer("Bekor qilindi.")
+
+    # karta tahriri fonda (coalesce) ketadi, mijozga xabar darhol
+    await edit_group_card(context, o)
+    await notify_user(context, o.user_id, "❌ Buyurtma bekor qilindi.")
+
+async def cb_accept(q, context: ContextTypes.DEFAULT_TYPE, o: Order):
+    u = q.from_user
+    patch = {
+        "status": "assigned",
+        "driver_id": u.id,
+        "driver_name": u.full_name or "",
+        "driver_username": f"@{u.username}" if u.username else "",
+    }
+    driver_disp = patch["driver_username"] or patch["driver_name"] or "Haydovchi"
+
+    o = cas_order_status(o.order_id, "posted", **patch)
     if not o:
-        await q.answer("Buyurtma topilmadi.", show_alert=True)
+        await q.answer("Bu buyurtma endi aktiv emas.", show_alert=True)
         return
 
-    if action == "cancel":
-        if q.from_user.id != o.user_id:
-            await q.answer("Bekor qilish faqat buyurtmachiga mumkin.", show_alert=True)
-            return
-        if o.status in ("cancelled",):
-            await q.answer("Allaqachon bekor qilingan.", show_alert=True)
-            return
-        if o.status == "assigned":
-            await q.answer("Haydovchi biriktirilgan. Bekor qilib bo‘lmaydi.", show_alert=True)
-            return
-
-        o.status = "cancelled"
-        update_order(o)
-        delete_job(context.job_queue, remind_job_name(order_id))
+    cancel_reminder(o.order_id)
+    await q.answer("Qabul qilindi ✅")
 
-        try:
-            if o.group_message_id:
-                await context.bot.edit_message_text(
-                    chat_id=ALLOWED_CHAT_ID,
-                    message_id=o.group_message_id,
-                    message_thread_id=TAXI_TOPIC_ID,
-                    text=order_card_text(o),
-                    reply_markup=order_keyboard(o),
-                    disable_web_page_preview=True,
-                )
-        except Exception:
-            pass
+    await edit_group_card(context, o)
+    await notify_user(
+        context,
+        o.user_id,
+        "✅ Haydovchi topildi!\n"
+        f"🚖 Haydovchi: {driver_disp}\n\n"
+        "Aloqa uchun haydovchiga yozing.",
+    )
 
-        try:
-            await context.bot.send_message(chat_id=o.user_id, text="❌ Buyurtma bekor qilindi.")
-        except Exception:
-            pass
+async def cb_driver_cancel(q, context: ContextTypes.DEFAULT_TYPE, o: Order):
+    uid = q.from_user.id
+    if not (uid == (o.driver_id or -1) or is_admin(uid)):
+        await q.answer("Bu tugma faqat haydovchi yoki admin uchun.", show_alert=True)
+        return
 
-        await q.answer("Bekor qilindi.")
+    # holat yuborishdan oldin saqlanadi: send paytida boshqa handlerlar
+    # (admin cancel, /setprice, takroriy bosish) to'liq holatni ko'radi
+    o = cas_order_status(
+        o.order_id,
+        "assigned",
+        status="posted",
+        driver_id=None,
+        driver_name="",
+        driver_username="",
+    )
+    if not o:
+        await q.answer("Bu order hozir assigned emas.", show_alert=True)
         return
 
-    if action == "accept":
-        if o.status != "posted":
-            await q.answer("Bu buyurtma endi aktiv emas.", show_alert=True)
-            return
+    # Repost rate limiter navbatida uzoq kutishi mumkin — tugmaga hozir javob
+    # beriladi (keyin "Query is too old" bo'lardi), xatolik esa DM orqali.
+    await safe_call(lambda: q.answer("Qayta e’lon qilinmoqda…"))
 
-        o.status = "assigned"
-        o.driver_id = q.from_user.id
-        o.driver_name = q.from_user.full_name or ""
-        o.driver_username = f"@{q.from_user.username}" if q.from_user.username else ""
-        update_order(o)
+    try:
+        mid = await post_order_to_group(context, o, delete_old=True)
+    except Exception:
+        log.exception("driver_cancel repost failed")
+        schedule_reminder(o.order_id)  # sweep keyinroq qayta urinadi
+        await notify_user(context, uid, "⚠️ Qayta e’lon qilishda xatolik. Birozdan keyin avtomatik qayta e’lon qilinadi.")
+        return
 
-        delete_job(context.job_queue, remind_job_name(order_id))
+    cur = await finish_repost(context, o.order_id, mid)
+    if not cur or cur.status != "posted":
+        return
 
-        try:
-            if o.group_message_id:
-                await context.bot.edit_message_text(
-                    chat_id=ALLOWED_CHAT_ID,
-                    message_id=o.group_message_id,
-                    message_thread_id=TAXI_TOPIC_ID,
-                    text=order_card_text(o),
-                    reply_markup=order_keyboard(o),
-                    disable_web_page_preview=True,
-                )
-        except Exception:
-            pass
+    schedule_reminder(cur.order_id)
 
-        try:
-            driver_disp = o.driver_username or o.driver_name or "Haydovchi"
-            await context.bot.send_message(
-                chat_id=o.user_id,
-                text=(
-                    "✅ Haydovchi topildi!\n"
-                    f"🚖 Haydovchi: {driver_disp}\n\n"
-                    "Aloqa uchun haydovchiga yozing."
-                ),
-            )
-        except Exception:
-            pass
-
-        await q.answer("Qabul qilindi ✅")
-        return
+    await notify_user(
+        context,
+        cur.user_id,
+        "⚠️ Haydovchi buyurtmani bekor qildi. Buyurtma qayta e’lon qilindi, haydovchi kutilmoqda.",
+    )
 
-    if action == "driver_cancel":
-        uid = q.from_user.id
-        if not (uid == (o.driver_id or -1) or is_admin(uid)):
-            await q.answer("Bu tugma faqat haydovchi yoki admin uchun.", show_alert=True)
-            return
+# "<action>:<order_id>" -> handler(q, context, o)
+CALLBACK_ACTIONS = {
+    "cancel": cb_cancel,
+    "accept": cb_accept,
+    "driver_cancel": cb_driver_cancel,
+}
 
-        if o.status != "assigned":
-            await q.answer("Bu order hozir assigned emas.", show_alert=True)
-            return
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not q or not q.data:
+        return
 
-        o.status = "posted"
-        o.driver_id = None
-        o.driver_name = ""
-        o.driver_username = ""
-        update_order(o)
+    # faqat allowed group + taxi topic ichida ishlasin.
+    # Har bir yo'l q.answer() ni aynan bir marta chaqiradi.
+    m = q.message
+    if (
+        not m
+        or not m.chat
+        or m.chat.id != ALLOWED_CHAT_ID
+        or getattr(m, "message_thread_id", None) != TAXI_TOPIC_ID
+    ):
+        await q.answer()
+        return
 
-        try:
-            mid = await post_order_to_group(context, o, delete_old=True)
-            o.group_message_id = mid
-            update_order(o)
-        except Exception:
-            log.exception("driver_cancel repost failed")
-            await q.answer("Qayta e’lon qilishda xatolik.", show_alert=True)
-            return
+    action, sep, order_id = q.data.partition(":")
+    handler = CALLBACK_ACTIONS.get(action) if sep else None
+    if not handler:
+        await q.answer()
+        return
 
-        schedule_reminder(context.application, o.order_id)
+    o = load_order(order_id)
+    if not o:
+        await q.answer("Buyurtma topilmadi.", show_alert=True)
+        return
 
-        try:
-            await context.bot.send_message(
-                chat_id=o.user_id,
-                text="⚠️ Haydovchi buyurtmani bekor qildi. Buyurtma qayta e’lon qilindi, haydovchi kutilmoqda."
-            )
-        except Exception:
-            pass
+    await handler(q, context, o)
 
-        await q.answer("Qayta e’lon qilindi ✅")
+# ================== SNAPSHOT JOB ==================
+async def snapshot_tick(context: ContextTypes.DEFAULT_TYPE):
+    # Encode on the loop (consistent view of STATE), write the file in a
+    # thread. Deltas logged meanwhile go to a fresh WAL, so nothing is lost.
+    global _DIRTY
+    if not _DIRTY:
+        return
+    data = encode_state(STATE)
+    try:
+        rotate_wal()
+    except Exception:
+        log.exception("state wal rotate failed")
         return
+    _DIRTY = False
+    if await asyncio.to_thread(write_snapshot, data):
+        drop_wal_old()
+    else:
+        _DIRTY = True
+
+async def wal_flush_tick(context: ContextTypes.DEFAULT_TYPE):
+    flush_wal()
 
 # ================== MAIN ==================
+def cancel_stale_pending() -> None:
+    # to'ldirilayotgan buyurtmalar restartdan keyin davom ettirib bo'lmaydi
+    stale = [oid for oid, data in ORDERS.items() if data.get("status") == "pending"]
+    for oid in stale:
+        o = load_order(oid)
+        if o:
+            o.status = "cancelled"
+            update_order(o)
+    if stale:
+        log.info("cancelled %s unfinished orders from before restart", len(stale))
+
 async def on_startup(app: Application):
-    reschedule_all_posted(app)
+    cancel_stale_pending()
+    reschedule_all_posted()
+    if app.job_queue:
+        app.job_queue.run_repeating(
+            callback=reminder_tick,
+            interval=REMIND_SWEEP_SEC,
+            first=REMIND_SWEEP_SEC,
+            name="remind",
+        )
+        app.job_queue.run_repeating(
+            callback=snapshot_tick,
+            interval=SNAPSHOT_EVERY_SEC,
+            first=SNAPSHOT_EVERY_SEC,
+            name="snapshot",
+        )
+        app.job_queue.run_repeating(
+            callback=wal_flush_tick,
+            interval=WAL_FLUSH_EVERY_SEC,
+            first=WAL_FLUSH_EVERY_SEC,
+            name="wal_flush",
+        )
+
+async def on_shutdown(app: Application):
+    save_state(STATE)
+    _wal_fp.close()
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).post_init(on_startup).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(256)
+        # HTTP/2: parallel API so'rovlar bitta ulanishda multiplex bo'ladi
+        .http_version("2")
+        .read_timeout(20)
+        .write_timeout(20)
+        # Bot API limits: ~30 msg/s overall, 20 msg/min per group; 429 da kutib qayta yuboradi
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("taksi", taxi_cmd))
-    app.add_handler(CommandHandler("cancel", cancel_cmd))
+    app.add_handler(CommandHandler("start", start_cmd, block=False))
+    app.add_handler(CommandHandler("taksi", taxi_cmd, block=False))
+    app.add_handler(CommandHandler("cancel", cancel_cmd, block=False))
 
-    app.add_handler(CommandHandler("setinterval", setinterval_cmd))
-    app.add_handler(CommandHandler("setprice", setprice_cmd))
+    app.add_handler(CommandHandler("setinterval", setinterval_cmd, block=False))
+    app.add_handler(CommandHandler("setprice", setprice_cmd, block=False))
 
     # ✅ ADMIN PANEL handlers
-    app.add_handler(CommandHandler("admin", admin_cmd))
-    app.add_handler(CallbackQueryHandler(admin_callback, pattern=r"^adm:"))
+    app.add_handler(CommandHandler("admin", admin_cmd, block=False))
+    app.add_handler(CallbackQueryHandler(admin_callback, pattern=r"^adm:", block=False))
 
-    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & (filters.TEXT | filters.LOCATION | filters.CONTACT), private_router))
-    app.add_handler(CallbackQueryHandler(on_callback))
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & (filters.TEXT | filters.LOCATION | filters.CONTACT), private_router, block=False))
+    app.add_handler(CallbackQueryHandler(on_callback, block=False))
 
     log.info(
         "✅ Taksi bot ishga tushdi. ALLOWED_CHAT_ID=%s TAXI_TOPIC_ID=%s remind=%smin",
@@ -1011,7 +1422,7 @@ def main():
         TAXI_TOPIC_ID,
         get_remind_every_sec() // 60,
     )
-    app.run_polling(drop_pending_updates=True)
+    app.run_polling(drop_pending_updates=True, timeout=20)
 
 if __name__ == "__main__":
     main()